@@ -5,15 +5,41 @@ SAFE VERSION - NO NAME ERRORS
 """
 
 import os
+import time
+
+# Timestamps are shown as WIB, set the zone before pandas/yfinance load
+os.environ.setdefault("TZ", "Asia/Jakarta")
+# tzset is Unix-only; Windows keeps the system zone
+if hasattr(time, "tzset"):
+    time.tzset()
+
+import re
+import atexit
+import hashlib
 import sys
+import asyncio
 import logging
+import queue
+import httpx
+import requests
 import yfinance as yf
 import pandas as pd
+from collections import OrderedDict
+from html import escape
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+from typing import Awaitable, Callable, Dict, Optional
+
+# Keep yfinance's timezone cache in one writable place
+yf.set_tz_cache_location("/tmp/yf")
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
 # Try to import Gemini, fallback gracefully
 try:
@@ -23,6 +49,26 @@ except ImportError:
     GEMINI_AVAILABLE = False
     print("Warning: google-generativeai not installed, AI features disabled")
 
+# Try to import Redis, fallback to the in-process cache
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Try to import orjson for the Redis payloads, fallback to the stdlib json
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
+# Try to import uvloop, fallback to the default asyncio loop
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -33,6 +79,11 @@ BOT_NAME = os.getenv("BOT_NAME", "AkademikSaham_AIbot")
 PORT = int(os.getenv("PORT", 8080))
 WEBHOOK_ENABLED = os.getenv("WEBHOOK_ENABLED", "false").lower() == "true"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", 10))
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", 800))
+# gemini-pro (1.0) rejects system instructions, so default to 1.5 Flash
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
 
 # Safe AI key loading - support both old and new
 AI_API_KEY = None
@@ -43,17 +94,46 @@ for key_name in ["GEMINI_API_KEY", "OPENAI_API_KEY"]:
         print(f"Found AI key: {key_name}")
         break
 
+# Role for stock/investment focused AI, set once on the model so each
+# request only carries the question. The disclaimer is appended in
+# ai_chat and answer length is capped by AI_MAX_TOKENS.
+AI_SYSTEM_INSTRUCTION = "Anda asisten edukasi saham dan investasi Indonesia (fokus BEI). Jawab akurat dalam bahasa Indonesia yang mudah dipahami, beri contoh konkret bila relevan."
+
 # Initialize Gemini AI safely
 gemini_model = None
 if AI_API_KEY and GEMINI_AVAILABLE:
     try:
         genai.configure(api_key=AI_API_KEY)
-        gemini_model = genai.GenerativeModel('gemini-pro')
+        gemini_model = genai.GenerativeModel(
+            GEMINI_MODEL,
+            generation_config={"max_output_tokens": AI_MAX_TOKENS},
+            system_instruction=AI_SYSTEM_INSTRUCTION,
+        )
         print("Gemini AI initialized successfully")
     except Exception as e:
         print(f"Gemini initialization error: {e}")
         gemini_model = None
 
+# Minimum seconds between edits while an AI answer streams in
+AI_EDIT_INTERVAL = 1.0
+
+# Room left in a Telegram message for the AI answer's header and disclaimer
+AI_MAX_ANSWER_CHARS = MessageLimit.MAX_TEXT_LENGTH - 200
+
+# Cap in-flight AI requests so concurrent users don't trip the rate limit
+ai_semaphore = asyncio.Semaphore(AI_CONCURRENCY)
+
+def is_quota_error(e: Exception) -> bool:
+    """Check if an AI API error is a quota/rate limit error"""
+    return "quota" in str(e).lower() or "429" in str(e)
+
+# IDX trades on Jakarta time regardless of the host's TZ
+WIB = ZoneInfo("Asia/Jakarta")
+
+def is_market_open(now: datetime) -> bool:
+    """Check if IDX is in its trading session (Mon-Fri 09:00-16:00 WIB)"""
+    return now.weekday() < 5 and 9 <= now.hour < 16
+
 POPULAR_STOCKS = {
     'BBCA.JK': 'Bank Central Asia',
     'BBRI.JK': 'Bank Rakyat Indonesia', 
@@ -69,8 +149,176 @@ POPULAR_STOCKS = {
     'BUKA.JK': 'Bukalapak'
 }
 
-# Setup logging - MINIMAL
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{code}"
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+# Any fc.yahoo.com hit sets the session cookie the crumb is tied to
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+QUOTE_BATCH_SIZE = 10
+USER_AGENT = "Mozilla/5.0"
+IHSG_CODE = "^JKSE"
+
+# Keyboards never change, build them once
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📈 Saham Populer", callback_data='popular')],
+    [InlineKeyboardButton("📊 Kondisi IHSG", callback_data='ihsg')],
+    [InlineKeyboardButton("🤖 Tanya AI", callback_data='ai_help')],
+    [InlineKeyboardButton("❓ Bantuan", callback_data='help')]
+])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Menu Utama", callback_data='back')]])
+
+# Change indicator, indexed by change_pct >= 0
+EMOJIS = ("🔴", "🟢")
+
+# Negative cache entry for symbols Yahoo doesn't know
+MISSING = {'__missing__': True}
+
+# HTML message templates; dynamic text is escaped before formatting
+STOCK_TEMPLATE = """📊 <b>{name}</b> ({display_code})
+
+{emoji} <b>Harga</b>: Rp {current_price:.0f}
+📈 <b>Perubahan</b>: {change_pct:+.2f}%
+📊 <b>Volume</b>: {volume:,.0f}
+
+🕐 <b>Update</b>: {fetched_at}
+
+💡 Ketik <code>/stock {display_code}</code> untuk update data"""
+
+POPULAR_ROW_TEMPLATE = "{emoji} <b>{code}</b> - {name}\n   💰 Rp {current_price:.0f} ({change_pct:+.2f}%)\n\n"
+
+IHSG_TEMPLATE = """📊 <b>INDEKS HARGA SAHAM GABUNGAN</b>
+
+{emoji} <b>IHSG</b>: {current_price:.2f}
+📈 <b>Perubahan</b>: {change:+.2f} ({change_pct:+.2f}%)
+
+🕐 <b>Update</b>: {fetched_at}"""
+
+# Gemini marks emphasis with **bold**
+AI_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+
+# Static texts; the AI setup is fixed at startup, so its status is too
+AI_STATUS = "✅ Aktif" if gemini_model else "❌ Tidak aktif"
+AI_AVAILABILITY = "✅ Tersedia" if gemini_model else "❌ Tidak tersedia"
+
+# {user} is filled with str.replace, so braces in BOT_NAME stay literal
+START_TEMPLATE = f"""🎉 Selamat datang di {escape(BOT_NAME)}, {{user}}!
+
+📱 <b>Menu tersedia:</b>
+• <code>/ask [pertanyaan]</code> - Tanya AI tentang saham/investasi
+• <code>/stock KODE</code> - Cari saham tertentu
+• Atau pilih tombol di bawah
+• Atau ketik langsung kode saham
+
+🤖 <b>AI Status</b>: {AI_STATUS}
+
+💡 <b>Contoh</b>: 
+• <code>/ask Apa itu saham?</code>
+• <code>/stock BBCA</code>
+• Ketik: <code>GOTO</code>"""
+
+MAIN_MENU_TEXT = f"""🏠 {escape(BOT_NAME)} - Menu Utama
+
+📱 <b>Cara menggunakan:</b>
+• <code>/ask [pertanyaan]</code> - Tanya AI tentang investasi
+• <code>/stock KODE</code> - Cari saham tertentu  
+• Atau ketik langsung kode saham
+• Atau pilih menu di bawah
+
+🤖 <b>AI Status</b>: {AI_STATUS}"""
+
+ASK_USAGE_TEXT = f"""🤖 <b>AI Assistant - {"Tersedia" if gemini_model else "Tidak Tersedia"}</b>
+
+<b>Format:</b> <code>/ask [pertanyaan Anda]</code>
+
+<b>Contoh pertanyaan:</b>
+• <code>/ask Apa itu saham?</code>
+• <code>/ask Bagaimana cara memulai investasi?</code>
+• <code>/ask Perbedaan saham dan obligasi?</code>
+• <code>/ask Analisis fundamental vs teknikal?</code>
+• <code>/ask Tips investasi untuk pemula?</code>
+• <code>/ask Risiko investasi saham?</code>
+
+💡 AI akan menjawab dengan fokus pada pasar saham Indonesia"""
+
+HELP_TEXT = f"""❓ <b>BANTUAN {escape(BOT_NAME)}</b>
+
+<b>Cara Menggunakan:</b>
+• <code>/start</code> - Mulai menggunakan bot
+• <code>/ask [pertanyaan]</code> - Tanya AI tentang saham/investasi
+• <code>/stock KODE</code> - Cari saham tertentu
+• Pilih menu dari tombol yang tersedia
+• Atau ketik kode saham langsung
+
+<b>Contoh penggunaan:</b>
+• <code>/ask Apa itu saham?</code>
+• <code>/stock BBCA</code> → Info Bank BCA  
+• <code>/stock GOTO</code> → Info GoTo
+• Ketik: <code>BBRI</code> → Info Bank BRI
+
+<b>Fitur:</b>
+✅ Data real-time saham Indonesia
+✅ Informasi IHSG
+✅ Saham-saham populer
+{AI_AVAILABILITY} AI Assistant untuk konsultasi investasi
+✅ Interface yang mudah digunakan
+
+🔄 Bot akan coba mengambil data real-time
+📊 Jika Yahoo Finance maintenance, fitur pencarian tetap tersedia"""
+
+if not AI_API_KEY:
+    AI_HELP_TEXT = "🤖 <b>AI Assistant</b>\n\n❌ AI Assistant tidak tersedia (API key tidak dikonfigurasi di Railway Variables)"
+elif not gemini_model:
+    AI_HELP_TEXT = """🤖 <b>AI Assistant</b>
+
+❌ AI tidak tersedia saat ini
+
+🔧 <b>Untuk mengaktifkan:</b>
+1. Install google-generativeai
+2. Set <code>GEMINI_API_KEY</code> di Railway
+3. Restart bot"""
+else:
+    AI_HELP_TEXT = """🤖 <b>AI Assistant - Powered by Google Gemini</b>
+
+<b>Cara menggunakan:</b>
+• <code>/ask [pertanyaan]</code> - Tanya langsung ke AI
+• Atau ketik pertanyaan langsung (dengan tanda tanya)
+
+<b>Contoh pertanyaan:</b>
+• <code>/ask Apa itu saham?</code>
+• <code>/ask Bagaimana cara investasi yang aman?</code>
+• <code>/ask Perbedaan saham dan reksa dana?</code>
+• <code>/ask Analisis fundamental itu apa?</code>
+• <code>Kapan waktu yang tepat beli saham?</code>
+
+<b>AI ini bisa membantu:</b>
+✅ Edukasi dasar investasi
+✅ Penjelasan istilah keuangan
+✅ Tips strategi investasi
+✅ Analisis konsep saham
+✅ Diskusi risiko investasi
+
+🆓 <b>Gratis</b>: 1500 pertanyaan per hari
+⚠️ <b>Disclaimer</b>: AI memberikan informasi edukasi, bukan nasihat investasi pribadi"""
+
+# Popular codes with and without the .JK suffix, mapped both ways
+DISPLAY_TO_FULL = {code.removesuffix('.JK'): code for code in POPULAR_STOCKS}
+FULL_TO_DISPLAY = {full: display for display, full in DISPLAY_TO_FULL.items()}
+
+# Bare IDX codes, with or without the Yahoo ".JK" suffix
+TICKER_RE = re.compile(r"^([A-Za-z]{1,6})(?:\.JK)?$", re.IGNORECASE)
+
+# Question words also match suffixed forms like "apakah"
+QUESTION_RE = re.compile(r"\b(?:apa|bagaimana|mengapa|kenapa|kapan|di\s*mana|siapa)|\?", re.IGNORECASE)
+
+# Setup logging - MINIMAL, written to stderr from a background thread
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log_listener = QueueListener(queue.SimpleQueue(), _log_handler, respect_handler_level=True)
+_queue_handler = QueueHandler(log_listener.queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logging.getLogger("telegram").setLevel(logging.WARNING)
 logging.getLogger("yfinance").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.ERROR)
@@ -81,84 +329,467 @@ logger = logging.getLogger(__name__)
 class StockBot:
     def __init__(self):
         self.popular_stocks = POPULAR_STOCKS
-        self.stock_cache: Dict[str, tuple[dict, datetime]] = {}
+        self.stock_cache: OrderedDict[str, tuple[dict, datetime]] = OrderedDict()
         self.cache_expiry = timedelta(minutes=5)
+        # The index moves every tick, keep it fresher than single stocks
+        # while the market is open; it only changes at the close otherwise
+        self.index_expiry = timedelta(seconds=60)
+        self.index_closed_expiry = timedelta(minutes=10)
+        self.cache_size = 512
+        self.missing_expiry = timedelta(seconds=60)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # Cap parallel upstream fetches to avoid Yahoo 429s
+        self._fetch_semaphore = asyncio.Semaphore(8)
+        # Only one yf.download may run at a time
+        self._download_lock = asyncio.Lock()
+        # Optional Redis cache shared across restarts and replicas
+        self.redis = aioredis.from_url(REDIS_URL) if REDIS_URL and REDIS_AVAILABLE else None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Shared HTTP session keeps Yahoo connections alive between calls
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        # Room for yf.download's worker threads to reuse pooled connections
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+        self._tickers: Dict[str, yf.Ticker] = {}
+        # Async client for the Yahoo chart endpoint on the hot path
+        self.http = httpx.AsyncClient(timeout=5.0, headers={"User-Agent": USER_AGENT})
+        # Crumb for the multi-symbol quote endpoint, fetched on first use
+        self._crumb: Optional[str] = None
+        self._crumb_lock = asyncio.Lock()
+        # After a failure the quote endpoint is skipped until this time
+        self._quote_retry_at = datetime.min
+        self.ai_cache: OrderedDict[str, tuple[str, datetime]] = OrderedDict()
+        self.ai_cache_expiry = timedelta(hours=24)
+        self.ai_cache_size = 512
         logger.info(f"Bot initialized with {len(self.popular_stocks)} stocks")
 
-    async def get_stock_data(self, code: str) -> Optional[dict]:
-        """Get stock data with simple caching"""
-        # Check cache first
+    def _expiry(self, data: dict) -> timedelta:
+        """Cache lifetime for an entry"""
+        if data is MISSING:
+            return self.missing_expiry
+        if data['code'] != IHSG_CODE:
+            return self.cache_expiry
+        return self.index_expiry if is_market_open(datetime.now(WIB)) else self.index_closed_expiry
+
+    def _cached(self, code: str) -> Optional[dict]:
+        """Return cached stock data (or MISSING) if still fresh"""
         if code in self.stock_cache:
             data, timestamp = self.stock_cache[code]
-            if datetime.now() - timestamp < self.cache_expiry:
+            if datetime.now() - timestamp < self._expiry(data):
+                self.stock_cache.move_to_end(code)
                 return data
+        return None
+
+    def _cache_put(self, code: str, data: dict, timestamp: Optional[datetime] = None):
+        """Cache stock data, evicting expired and least recently used entries"""
+        now = datetime.now()
+        self.stock_cache[code] = (data, timestamp or now)
+        self.stock_cache.move_to_end(code)
+        
+        # Opportunistically purge expired entries from the old end
+        for old_code in list(islice(self.stock_cache, 8)):
+            old_data, old_timestamp = self.stock_cache[old_code]
+            if now - old_timestamp >= self._expiry(old_data):
+                del self.stock_cache[old_code]
+        
+        while len(self.stock_cache) > self.cache_size:
+            self.stock_cache.popitem(last=False)
+
+    async def get_stock_data(self, code: str) -> Optional[dict]:
+        """Get stock data with simple caching"""
+        # Check cache first
+        data = self._cached(code)
+        if data:
+            self.cache_hits += 1
+            return None if data is MISSING else data
+
+        # Concurrent callers for the same code share one upstream fetch
+        task = self._inflight.get(code) or self._track(code, self._fetch(code))
+        # Shielded so a cancelled caller doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def _track(self, code: str, coro) -> asyncio.Task:
+        """Run a fetch for code as its in-flight task until it finishes"""
+        task = asyncio.create_task(coro)
+        self._inflight[code] = task
+        task.add_done_callback(lambda t: self._inflight.pop(code, None) if self._inflight.get(code) is t else None)
+        return task
+
+    async def _fetch(self, code: str) -> Optional[dict]:
+        """Fetch stock data and cache it"""
+        cached = await self._redis_get(code)
+        if cached:
+            self.cache_hits += 1
+            self._cache_put(code, *cached)
+            return None if cached[0] is MISSING else cached[0]
+        self.cache_misses += 1
+        
+        async with self._fetch_semaphore:
+            try:
+                # Unknown symbols are remembered briefly so retries skip Yahoo
+                data = await self._fetch_chart(code) or MISSING
+            except Exception as e:
+                logger.warning(f"Chart endpoint failed for {code}, falling back to yfinance: {e}")
+                # yfinance is blocking, keep it off the event loop
+                data = await asyncio.to_thread(self._fetch_sync, code)
+        if data:
+            self._cache_put(code, data)
+            await self._redis_set({code: data})
+        return None if data is MISSING else data
 
+    async def _redis_get(self, code: str) -> Optional[tuple[dict, datetime]]:
+        """Read stock data and its fetch time from Redis"""
+        if not self.redis:
+            return None
         try:
-            ticker = yf.Ticker(code)
-            hist = ticker.history(period="5d")
-            
-            if hist.empty:
-                return None
-                
-            current_price = hist['Close'].iloc[-1]
-            prev_close = hist['Close'].iloc[-2] if len(hist) > 1 else current_price
-            change = current_price - prev_close
-            change_pct = (change / prev_close * 100) if prev_close else 0
-            
-            data = {
-                'code': code,
-                'name': self.popular_stocks.get(code, code.replace('.JK', '')),
-                'current_price': current_price,
-                'change': change,
-                'change_pct': change_pct,
-                'volume': hist['Volume'].iloc[-1] if not hist['Volume'].empty else 0,
-            }
-            
-            # Cache the result
-            self.stock_cache[code] = (data, datetime.now())
-            return data
-            
+            raw = await self.redis.get(f"stk:{code}")
+        except Exception as e:
+            logger.warning(f"Redis get failed, using local cache only: {e}")
+            return None
+        if raw is None:
+            return None
+        data, timestamp = json_loads(raw)
+        if data == MISSING:
+            data = MISSING
+        timestamp = datetime.fromtimestamp(timestamp)
+        # The Redis expiry was set under the TTL at write time, which can be
+        # longer than today's (IHSG after the market opens)
+        if datetime.now() - timestamp >= self._expiry(data):
+            return None
+        return data, timestamp
+
+    async def _redis_set(self, items: Dict[str, dict]):
+        """Write stock data to Redis, expiring with the cache TTL"""
+        if not self.redis or not items:
+            return
+        timestamp = datetime.now().timestamp()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for code, data in items.items():
+                    ttl = int(self._expiry(data).total_seconds())
+                    pipe.set(f"stk:{code}", json_dumps([data, timestamp]), ex=ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis set failed, using local cache only: {e}")
+
+    async def _fetch_chart(self, code: str) -> Optional[dict]:
+        """Fetch stock data straight from the Yahoo chart JSON, skipping pandas"""
+        r = await self.http.get(YAHOO_CHART_URL.format(code=code), params={"range": "5d", "interval": "1d"})
+        if r.status_code == 404:
+            # Unknown symbol
+            return None
+        r.raise_for_status()
+        
+        result = r.json()["chart"]["result"]
+        if not result:
+            return None
+        quote = result[0]["indicators"]["quote"][0]
+        # Yahoo emits nulls for days without trading
+        bars = [(c, v) for c, v in zip(quote.get("close") or [], quote.get("volume") or []) if c is not None]
+        if not bars:
+            return None
+        
+        current_price, volume = bars[-1]
+        prev_close = bars[-2][0] if len(bars) > 1 else current_price
+        change = current_price - prev_close
+        change_pct = (change / prev_close * 100) if prev_close else 0
+        return self._make_data(code, current_price, change, change_pct, volume or 0)
+
+    async def _get_crumb(self) -> str:
+        """Fetch the cookie-bound crumb the v7 quote endpoint requires"""
+        # One cookie/crumb fetch at a time; batches waiting on it reuse the result
+        async with self._crumb_lock:
+            if self._crumb is None:
+                if datetime.now() < self._quote_retry_at:
+                    raise RuntimeError("quote endpoint is cooling down after a failure")
+                try:
+                    await self.http.get(YAHOO_COOKIE_URL)
+                    r = await self.http.get(YAHOO_CRUMB_URL)
+                    r.raise_for_status()
+                except Exception:
+                    self._quote_retry_at = datetime.now() + self.cache_expiry
+                    raise
+                self._crumb = r.text
+            return self._crumb
+
+    async def _quote_batch(self, codes: list) -> Dict[str, dict]:
+        """Fetch up to QUOTE_BATCH_SIZE quotes in one request"""
+        params = {"symbols": ",".join(codes), "crumb": await self._get_crumb()}
+        r = await self.http.get(YAHOO_QUOTE_URL, params=params)
+        if r.status_code == 401:
+            # Crumb expired, fetch a new one next time
+            self._crumb = None
+        r.raise_for_status()
+        
+        results = {}
+        for quote in r.json()["quoteResponse"]["result"]:
+            price = quote.get("regularMarketPrice")
+            if price is None:
+                continue
+            prev_close = quote.get("regularMarketPreviousClose") or price
+            change = price - prev_close
+            change_pct = change / prev_close * 100 if prev_close else 0
+            code = quote["symbol"]
+            results[code] = self._make_data(code, price, change, change_pct, quote.get("regularMarketVolume") or 0)
+        return results
+
+    async def _bulk_quote(self, codes: list) -> Dict[str, dict]:
+        """Fetch several quotes with one request per batch of symbols"""
+        # Recently failed (e.g. getcrumb 429s): go straight to yf.download
+        if datetime.now() < self._quote_retry_at:
+            return {}
+        
+        batches = [codes[i:i + QUOTE_BATCH_SIZE] for i in range(0, len(codes), QUOTE_BATCH_SIZE)]
+        try:
+            replies = await asyncio.gather(*(self._quote_batch(batch) for batch in batches))
+        except Exception as e:
+            logger.warning(f"Quote endpoint failed, using yf.download for {self.cache_expiry}: {e}")
+            self._quote_retry_at = datetime.now() + self.cache_expiry
+            return {}
+        return {code: data for reply in replies for code, data in reply.items()}
+
+    async def _prefetch_popular(self, codes: Optional[list] = None) -> Dict[str, dict]:
+        """Fetch several stocks in one batch, shared with concurrent lookups"""
+        # Codes already being fetched are left to that fetch
+        codes = [c for c in codes or self.popular_stocks if c not in self._inflight]
+        if not codes:
+            return {}
+        
+        # Register every code before the batch starts, so get_stock_data and
+        # overlapping prefetches wait on it instead of fetching again
+        batch = asyncio.create_task(self._fetch_batch(codes))
+        for code in codes:
+            self._track(code, self._from_batch(batch, code))
+        return await asyncio.shield(batch)
+
+    async def _from_batch(self, batch: asyncio.Task, code: str) -> Optional[dict]:
+        """Take one code from a batch, fetching it alone if the batch missed it"""
+        results = await batch
+        if code in results:
+            return results[code]
+        return await self._fetch(code)
+
+    async def _fetch_batch(self, codes: list) -> Dict[str, dict]:
+        """Fetch several stocks in batched requests and warm the cache"""
+        results = await self._bulk_quote(codes)
+        for code, data in results.items():
+            self._cache_put(code, data)
+        await self._redis_set(results)
+        
+        # Anything the quote endpoint didn't return goes through yf.download
+        missing = [c for c in codes if c not in results]
+        if missing:
+            results.update(await self._download(missing))
+        return results
+
+    async def _download(self, codes: list) -> Dict[str, dict]:
+        """Fetch several stocks with one yf.download call and warm the cache"""
+        try:
+            # yf.download keeps its results in module globals it resets on
+            # every call, so overlapping downloads can drop frames or hang
+            async with self._download_lock:
+                df = await asyncio.to_thread(
+                    yf.download, codes, period="2d", group_by="ticker", threads=True,
+                    progress=False, auto_adjust=False, session=self.session,
+                )
+        except Exception as e:
+            logger.error(f"Batch download error: {e}")
+            return {}
+        
+        if df.empty or not isinstance(df.columns, pd.MultiIndex):
+            # Nothing usable, get_stock_data falls back per ticker
+            return {}
+        
+        # Compute changes for all tickers at once instead of per row
+        present = [c for c in codes if c in df.columns.get_level_values(0)]
+        closes = pd.DataFrame({c: df[c]['Close'] for c in present}).ffill()
+        volumes = pd.DataFrame({c: df[c]['Volume'] for c in present})
+        last = closes.iloc[-1]
+        prev = closes.iloc[-2].fillna(last) if len(closes) > 1 else last
+        change = last - prev
+        pct = change.div(prev.where(prev != 0)).mul(100).fillna(0)
+        vols = volumes.iloc[-1].fillna(0)
+        
+        results = {}
+        for code, price, chg, chg_pct, vol in zip(present, last.values, change.values, pct.values, vols.values):
+            if pd.isna(price):
+                continue
+            data = self._make_data(code, price, chg, chg_pct, vol)
+            results[code] = data
+            self._cache_put(code, data)
+        await self._redis_set(results)
+        return results
+
+    async def refresh_popular(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: keep popular stocks and IHSG warm in the cache"""
+        await self._prefetch_popular(list(self.popular_stocks) + [IHSG_CODE])
+        logger.info(f"Stock cache: {self.cache_hits} hits, {self.cache_misses} misses")
+
+    async def refresh_ihsg(self, context: ContextTypes.DEFAULT_TYPE):
+        """Job: keep IHSG warm under its shorter TTL while the market is open"""
+        if not is_market_open(datetime.now(WIB)):
+            return
+        # Goes upstream even while the cached entry (or Redis) is still fresh
+        await self._prefetch_popular([IHSG_CODE])
+
+    async def close(self, application: Application):
+        """Close HTTP clients on shutdown"""
+        await self.http.aclose()
+        self.session.close()
+        if self.redis:
+            await self.redis.aclose()
+
+    def _ticker(self, code: str) -> yf.Ticker:
+        """Reuse Ticker objects so the exchange timezone is looked up once per code"""
+        ticker = self._tickers.get(code)
+        if ticker is None:
+            ticker = self._tickers[code] = yf.Ticker(code, session=self.session)
+            if len(self._tickers) > self.cache_size:
+                del self._tickers[next(iter(self._tickers))]
+        return ticker
+
+    def _fetch_sync(self, code: str) -> Optional[dict]:
+        """Fetch stock data from Yahoo Finance (blocking, run in a thread)"""
+        try:
+            ticker = self._ticker(code)
+            # Only the last two daily bars are used
+            hist = ticker.history(period="2d", interval="1d", actions=False, auto_adjust=False, prepost=False)
+            return self._build_data(code, hist)
         except Exception as e:
             logger.error(f"Error getting stock data for {code}: {e}")
             return None
 
+    def _build_data(self, code: str, hist: pd.DataFrame) -> Optional[dict]:
+        """Build the stock data dict from price history"""
+        if hist.empty:
+            return None
+            
+        # Plain array indexing skips pandas' indexer machinery for scalars
+        close = hist['Close'].to_numpy()
+        current_price = close[-1]
+        prev_close = close[-2] if close.size > 1 else current_price
+        change = current_price - prev_close
+        change_pct = (change / prev_close * 100) if prev_close else 0
+        
+        volumes = hist['Volume'].to_numpy()
+        volume = volumes[-1] if volumes.size else 0
+        return self._make_data(code, current_price, change, change_pct, volume)
+
+    def _make_data(self, code: str, price: float, change: float, change_pct: float, volume: float) -> dict:
+        """Build the cached stock data dict"""
+        return {
+            'code': code,
+            'name': self.popular_stocks.get(code) or code.removesuffix('.JK'),
+            'current_price': float(price),
+            'change': float(change),
+            'change_pct': float(change_pct),
+            'volume': float(volume),
+            # Shown as the update time, so it reflects when data was fetched
+            'fetched_at': datetime.now(WIB).strftime('%H:%M:%S WIB'),
+        }
+
     # ==================== AI FUNCTIONS ====================
     
-    async def ai_chat(self, user_question: str) -> str:
-        """AI chat using available AI service"""
+    async def _ai_cached(self, key: str) -> Optional[str]:
+        """Return a cached AI answer from memory or Redis"""
+        if key in self.ai_cache:
+            answer, timestamp = self.ai_cache[key]
+            if datetime.now() - timestamp < self.ai_cache_expiry:
+                self.ai_cache.move_to_end(key)
+                return answer
+            del self.ai_cache[key]
+        
+        if not self.redis:
+            return None
+        try:
+            raw = await self.redis.get(key)
+        except Exception as e:
+            logger.warning(f"Redis get failed, using local AI cache only: {e}")
+            return None
+        if raw is None:
+            return None
+        # Redis keeps its own TTL, the local copy restarts the clock
+        answer = raw.decode()
+        self._ai_cache_local(key, answer)
+        return answer
+
+    def _ai_cache_local(self, key: str, answer: str):
+        """Cache an AI answer in memory, evicting the least recently used"""
+        self.ai_cache[key] = (answer, datetime.now())
+        if len(self.ai_cache) > self.ai_cache_size:
+            self.ai_cache.popitem(last=False)
+
+    async def _ai_cache_put(self, key: str, answer: str):
+        """Cache an AI answer in memory and Redis"""
+        self._ai_cache_local(key, answer)
+        if not self.redis:
+            return
+        try:
+            await self.redis.set(key, answer, ex=int(self.ai_cache_expiry.total_seconds()))
+        except Exception as e:
+            logger.warning(f"Redis set failed, using local AI cache only: {e}")
+
+    def _format_ai(self, text: str, partial: bool = False) -> str:
+        """Wrap Gemini output as an HTML answer"""
+        # Trim to fit one message (escaping doesn't change the parsed length),
+        # then escape and restore Gemini's bold as HTML
+        body = AI_BOLD_RE.sub(r"<b>\1</b>", escape(text.strip()[:AI_MAX_ANSWER_CHARS]))
+        if partial:
+            return f"🤖 <b>AI Assistant (Gemini)</b>\n\n{body} …"
+        return f"🤖 <b>AI Assistant (Gemini)</b>\n\n{body}\n\n💡 <i>Ini hanya informasi edukasi, bukan nasihat investasi</i>"
+
+    async def ai_chat(self, user_question: str, on_partial: Optional[Callable[[str], Awaitable]] = None) -> str:
+        """AI chat using available AI service, streaming drafts to on_partial"""
         if not AI_API_KEY:
             return "❌ AI Assistant tidak tersedia (API key tidak dikonfigurasi)"
         
         if not gemini_model:
             return """❌ AI Assistant tidak tersedia saat ini
 
-🔧 **Untuk mengaktifkan AI:**
-1. Install: `pip install google-generativeai`
-2. Set GEMINI_API_KEY di Railway Variables
+🔧 <b>Untuk mengaktifkan AI:</b>
+1. Install: <code>pip install google-generativeai</code>
+2. Set <code>GEMINI_API_KEY</code> di Railway Variables
 3. Restart bot
 
-📊 Sementara gunakan fitur saham: `/stock BBCA`"""
+📊 Sementara gunakan fitur saham: <code>/stock BBCA</code>"""
+        
+        # Repeated questions are answered from cache
+        question = re.sub(r"\s+", " ", user_question.lower().strip())
+        key = "ai:" + hashlib.blake2b(question.encode(), digest_size=16).hexdigest()
+        answer = await self._ai_cached(key)
+        if answer:
+            return answer
         
+        draft = None
         try:
-            # Create enhanced prompt for stock/investment focused AI
-            enhanced_prompt = f"""Anda adalah AI assistant ahli saham dan investasi Indonesia. Berikan jawaban yang:
-
-1. Fokus pada saham Indonesia dan Bursa Efek Indonesia (BEI)
-2. Berikan informasi edukasi investasi yang baik dan akurat
-3. Gunakan bahasa Indonesia yang mudah dipahami
-4. Berikan contoh konkret jika relevan
-5. Maksimal 400 kata per jawaban
-6. Selalu tambahkan disclaimer bahwa ini hanya informasi edukasi, bukan nasihat investasi
-
-Pertanyaan: {user_question}
-
-Berikan jawaban yang informatif dan edukatif."""
-
-            response = gemini_model.generate_content(enhanced_prompt)
+            # Only the Gemini stream holds a slot; drafts go to Telegram separately
+            async with ai_semaphore:
+                try:
+                    response = await gemini_model.generate_content_async(user_question, stream=True)
+                except Exception as e:
+                    if not is_quota_error(e):
+                        raise
+                    # Retry once after a short backoff
+                    await asyncio.sleep(0.2)
+                    response = await gemini_model.generate_content_async(user_question, stream=True)
+                
+                # Show the answer as it arrives, throttled for Telegram's edit
+                # limits; a draft is skipped while the previous one is in flight
+                text = ""
+                last_edit = time.monotonic()
+                async for chunk in response:
+                    text += chunk.text
+                    if (on_partial and text.strip() and (draft is None or draft.done())
+                            and time.monotonic() - last_edit >= AI_EDIT_INTERVAL):
+                        draft = asyncio.create_task(on_partial(self._format_ai(text, partial=True)))
+                        last_edit = time.monotonic()
             
-            if response.text:
-                ai_response = response.text.strip()
-                return f"🤖 **AI Assistant (Gemini)**\n\n{ai_response}\n\n💡 *Ini hanya informasi edukasi, bukan nasihat investasi*"
+            if text.strip():
+                answer = self._format_ai(text)
+                
+                await self._ai_cache_put(key, answer)
+                return answer
             else:
                 return "❌ AI tidak dapat memberikan jawaban untuk pertanyaan ini"
             
@@ -166,130 +797,131 @@ Berikan jawaban yang informatif dan edukatif."""
             logger.error(f"AI API error: {e}")
             
             # Handle specific error types
-            if "quota" in str(e).lower() or "429" in str(e):
+            if is_quota_error(e):
                 return """❌ AI Assistant sementara tidak tersedia (quota habis)
 
-🔧 **Solusi:**
+🔧 <b>Solusi:</b>
 1. Cek usage di ai.google.dev
 2. Tunggu reset quota harian
-3. Atau gunakan fitur saham: `/stock BBCA`"""
+3. Atau gunakan fitur saham: <code>/stock BBCA</code>"""
             elif "safety" in str(e).lower():
                 return """❌ Pertanyaan tidak dapat dijawab karena policy keamanan
 
 💡 Coba pertanyaan yang lebih umum tentang investasi atau saham"""
             else:
-                return f"❌ AI Assistant bermasalah sementara. Coba lagi nanti."
+                return "❌ AI Assistant bermasalah sementara. Coba lagi nanti."
+        finally:
+            # Let the last draft land before the caller sends the final answer
+            if draft:
+                await asyncio.gather(draft, return_exceptions=True)
 
     # ==================== HANDLERS ====================
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Start command handler"""
         user = update.effective_user.first_name
-        keyboard = [
-            [InlineKeyboardButton("📈 Saham Populer", callback_data='popular')],
-            [InlineKeyboardButton("📊 Kondisi IHSG", callback_data='ihsg')],
-            [InlineKeyboardButton("🤖 Tanya AI", callback_data='ai_help')],
-            [InlineKeyboardButton("❓ Bantuan", callback_data='help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        ai_status = "✅ Aktif" if gemini_model else "❌ Tidak aktif"
-        
-        welcome = f"""🎉 Selamat datang di {BOT_NAME}, {user}!
-
-📱 **Menu tersedia:**
-• `/ask [pertanyaan]` - Tanya AI tentang saham/investasi
-• `/stock KODE` - Cari saham tertentu
-• Atau pilih tombol di bawah
-• Atau ketik langsung kode saham
-
-🤖 **AI Status**: {ai_status}
-
-💡 **Contoh**: 
-• `/ask Apa itu saham?`
-• `/stock BBCA`
-• Ketik: `GOTO`"""
-        
-        await update.message.reply_text(welcome, reply_markup=reply_markup)
+        welcome = START_TEMPLATE.replace("{user}", escape(user))
+        await update.message.reply_text(welcome, reply_markup=MAIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
 
     async def ask_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /ask command for AI chat"""
         if not context.args:
-            ai_status = "tersedia" if gemini_model else "tidak tersedia"
-            message = f"""🤖 **AI Assistant - {ai_status.title()}**
-
-**Format:** `/ask [pertanyaan Anda]`
-
-**Contoh pertanyaan:**
-• `/ask Apa itu saham?`
-• `/ask Bagaimana cara memulai investasi?`
-• `/ask Perbedaan saham dan obligasi?`
-• `/ask Analisis fundamental vs teknikal?`
-• `/ask Tips investasi untuk pemula?`
-• `/ask Risiko investasi saham?`
-
-💡 AI akan menjawab dengan fokus pada pasar saham Indonesia"""
-            
-            await update.message.reply_text(message, parse_mode='Markdown')
+            await update.message.reply_text(ASK_USAGE_TEXT, parse_mode=ParseMode.HTML)
             return
         
         # Join all arguments as the question
         question = " ".join(context.args)
         
-        # Show typing action
+        await self.reply_ai(update, question)
+
+    async def reply_ai(self, update: Update, question: str):
+        """Answer a question with AI, editing one message as the answer streams in"""
         await update.message.chat.send_action(action="typing")
+        sent = None
         
-        # Get AI response
-        ai_answer = await self.ai_chat(question)
+        async def show_draft(text: str):
+            nonlocal sent
+            try:
+                if sent is None:
+                    sent = await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                else:
+                    await sent.edit_text(text, parse_mode=ParseMode.HTML)
+            except TelegramError as e:
+                # Drafts are best effort, the final answer still gets sent
+                logger.warning(f"AI draft edit failed: {e}")
         
-        # Send response
-        await update.message.reply_text(ai_answer, parse_mode='Markdown')
+        ai_answer = await self.ai_chat(question, show_draft)
+        if sent is not None:
+            try:
+                await sent.edit_text(ai_answer, parse_mode=ParseMode.HTML)
+                return
+            except BadRequest as e:
+                # Don't leave the user with a truncated draft, reply afresh
+                logger.warning(f"AI answer edit failed, sending a new message: {e}")
+        await update.message.reply_text(ai_answer, parse_mode=ParseMode.HTML)
 
     async def stock_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /stock command"""
         if not context.args:
-            message = """📊 **Pencarian Saham**
+            message = """📊 <b>Pencarian Saham</b>
 
-**Format:** `/stock [KODE_SAHAM]`
+<b>Format:</b> <code>/stock [KODE_SAHAM]</code>
 
-**Contoh:**
-• `/stock BBCA` - Info Bank BCA
-• `/stock GOTO` - Info GoTo
-• `/stock TLKM` - Info Telkom
+<b>Contoh:</b>
+• <code>/stock BBCA</code> - Info Bank BCA
+• <code>/stock GOTO</code> - Info GoTo
+• <code>/stock TLKM</code> - Info Telkom
 
 💡 Atau langsung ketik kode saham tanpa command"""
             
-            await update.message.reply_text(message, parse_mode='Markdown')
+            await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+            return
+        
+        # Only ticker-shaped codes reach the Yahoo URL and the cache keys
+        match = TICKER_RE.match(context.args[0])
+        if not match:
+            message = f"❌ Saham <b>{escape(context.args[0].upper())}</b> tidak ditemukan"
+            await update.message.reply_text(message, parse_mode=ParseMode.HTML)
             return
         
-        stock_code = context.args[0].upper()
-        await self.search_stock(update, stock_code)
+        await self.search_stock(update, match.group(1).upper())
+
+    def _format_stock(self, data: dict) -> str:
+        """Format stock data as an HTML message"""
+        emoji = EMOJIS[data['change_pct'] >= 0]
+        return STOCK_TEMPLATE.format_map({
+            **data,
+            'emoji': emoji,
+            'name': escape(data['name']),
+            'display_code': escape(FULL_TO_DISPLAY.get(data['code']) or data['code'].removesuffix('.JK')),
+        })
 
     async def search_stock(self, update: Update, stock_code: str):
         """Search for specific stock"""
-        code = f"{stock_code}.JK" if not stock_code.endswith('.JK') else stock_code
+        display_code = stock_code.removesuffix('.JK')
+        code = DISPLAY_TO_FULL.get(display_code) or f"{display_code}.JK"
+        
+        # Codes Yahoo recently didn't know are rejected from the negative cache
+        data = self._cached(code)
+        if data is MISSING:
+            message = f"❌ Saham <b>{escape(stock_code)}</b> tidak ditemukan"
+            await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+            return
+        
+        # Fresh cache hit: answer in one message, no loading placeholder
+        if data:
+            await update.message.reply_text(self._format_stock(data), parse_mode=ParseMode.HTML)
+            return
         
         # Send loading message
         loading_msg = await update.message.reply_text("⏳ Mencari data saham...")
         
         data = await self.get_stock_data(code)
         if data:
-            emoji = "🟢" if data['change_pct'] >= 0 else "🔴"
-            display_code = data['code'].replace('.JK', '')
-            
-            message = f"""📊 **{data['name']}** ({display_code})
-
-{emoji} **Harga**: Rp {data['current_price']:.0f}
-📈 **Perubahan**: {data['change_pct']:+.2f}%
-📊 **Volume**: {data['volume']:,.0f}
-
-🕐 **Update**: {datetime.now().strftime('%H:%M:%S WIB')}
-
-💡 Ketik `/stock {display_code}` untuk update data"""
-            
-            await loading_msg.edit_text(message, parse_mode='Markdown')
+            await loading_msg.edit_text(self._format_stock(data), parse_mode=ParseMode.HTML)
         else:
-            await loading_msg.edit_text(f"❌ Saham **{stock_code}** tidak ditemukan", parse_mode='Markdown')
+            message = f"❌ Saham <b>{escape(stock_code)}</b> tidak ditemukan"
+            await loading_msg.edit_text(message, parse_mode=ParseMode.HTML)
 
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks"""
@@ -313,203 +945,114 @@ Berikan jawaban yang informatif dan edukatif."""
 
     async def show_main_menu(self, query):
         """Show main menu"""
-        keyboard = [
-            [InlineKeyboardButton("📈 Saham Populer", callback_data='popular')],
-            [InlineKeyboardButton("📊 Kondisi IHSG", callback_data='ihsg')],
-            [InlineKeyboardButton("🤖 Tanya AI", callback_data='ai_help')],
-            [InlineKeyboardButton("❓ Bantuan", callback_data='help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        ai_status = "✅ Aktif" if gemini_model else "❌ Tidak aktif"
-        
-        text = f"""🏠 {BOT_NAME} - Menu Utama
-
-📱 **Cara menggunakan:**
-• `/ask [pertanyaan]` - Tanya AI tentang investasi
-• `/stock KODE` - Cari saham tertentu  
-• Atau ketik langsung kode saham
-• Atau pilih menu di bawah
-
-🤖 **AI Status**: {ai_status}"""
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await query.edit_message_text(MAIN_MENU_TEXT, reply_markup=MAIN_MENU_MARKUP, parse_mode=ParseMode.HTML)
 
     async def show_popular_stocks(self, query):
         """Show popular stocks"""
         await query.edit_message_text("⏳ Mengambil data saham populer...")
         
-        message = "📈 **SAHAM POPULER INDONESIA**\n\n"
+        parts = ["📈 <b>SAHAM POPULER INDONESIA</b>\n\n"]
+        
+        # Fetch concurrently, limited to prevent timeout
+        codes = list(self.popular_stocks)[:6]
+        stale = [c for c in codes if not self._cached(c)]
+        if len(stale) > 1:
+            await self._prefetch_popular(stale)
+        results = await asyncio.gather(*(self.get_stock_data(c) for c in codes), return_exceptions=True)
         
         count = 0
-        for code, name in self.popular_stocks.items():
-            if count >= 6:  # Limit to prevent timeout
-                break
-                
-            data = await self.get_stock_data(code)
+        for code, data in zip(codes, results):
+            if isinstance(data, Exception):
+                logger.error(f"Error getting stock data for {code}: {data}")
+                continue
             if data:
-                emoji = "🟢" if data['change_pct'] >= 0 else "🔴"
-                stock_code = data['code'].replace('.JK', '')
-                message += f"{emoji} **{stock_code}** - {name[:18]}\n"
-                message += f"   💰 Rp {data['current_price']:.0f} ({data['change_pct']:+.2f}%)\n\n"
+                name = self.popular_stocks[code]
+                emoji = EMOJIS[data['change_pct'] >= 0]
+                stock_code = FULL_TO_DISPLAY[code]
+                parts.append(POPULAR_ROW_TEMPLATE.format(
+                    emoji=emoji,
+                    code=escape(stock_code),
+                    name=escape(name[:18]),
+                    current_price=data['current_price'],
+                    change_pct=data['change_pct'],
+                ))
                 count += 1
         
         if count == 0:
-            message += "📊 Data saham sedang tidak tersedia\n(Yahoo Finance maintenance)\n\n"
+            parts.append("📊 Data saham sedang tidak tersedia\n(Yahoo Finance maintenance)\n\n")
             if gemini_model:
-                message += "💡 Coba tanya AI tentang saham:\n`/ask Analisis saham BBCA`"
+                parts.append("💡 Coba tanya AI tentang saham:\n<code>/ask Analisis saham BBCA</code>")
         
-        keyboard = [[InlineKeyboardButton("🏠 Menu Utama", callback_data='back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = "".join(parts)
         
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(message, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
 
     async def show_ihsg(self, query):
         """Show IHSG data"""
         await query.edit_message_text("⏳ Mengambil data IHSG...")
         
         try:
-            ihsg = yf.Ticker("^JKSE")
-            hist = ihsg.history(period="2d")
+            data = await self.get_stock_data(IHSG_CODE)
             
-            if not hist.empty:
-                current = hist['Close'].iloc[-1]
-                prev = hist['Close'].iloc[-2] if len(hist) > 1 else current
-                change = current - prev
-                change_pct = (change / prev * 100) if prev else 0
-                
-                emoji = "🟢" if change_pct >= 0 else "🔴"
-                message = f"""📊 **INDEKS HARGA SAHAM GABUNGAN**
-
-{emoji} **IHSG**: {current:.2f}
-📈 **Perubahan**: {change:+.2f} ({change_pct:+.2f}%)
-
-🕐 **Update**: {datetime.now().strftime('%H:%M:%S WIB')}"""
+            if data:
+                emoji = EMOJIS[data['change_pct'] >= 0]
+                message = IHSG_TEMPLATE.format(emoji=emoji, **data)
             else:
                 message = """❌ Data IHSG tidak tersedia saat ini
 (Yahoo Finance sedang maintenance)"""
                 
                 if gemini_model:
-                    message += "\n\n💡 Tanya AI tentang IHSG:\n`/ask Apa itu IHSG dan bagaimana cara membacanya?`"
+                    message += "\n\n💡 Tanya AI tentang IHSG:\n<code>/ask Apa itu IHSG dan bagaimana cara membacanya?</code>"
                 
         except Exception as e:
             logger.error(f"IHSG error: {e}")
             message = "❌ Error mengambil data IHSG"
             
             if gemini_model:
-                message += "\n\n💡 Tanya AI tentang pasar saham:\n`/ask Bagaimana kondisi pasar saham Indonesia?`"
-        
-        keyboard = [[InlineKeyboardButton("🏠 Menu Utama", callback_data='back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+                message += "\n\n💡 Tanya AI tentang pasar saham:\n<code>/ask Bagaimana kondisi pasar saham Indonesia?</code>"
         
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(message, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
 
     async def show_ai_help(self, query):
         """Show AI Assistant help"""
-        if not AI_API_KEY:
-            message = "🤖 **AI Assistant**\n\n❌ AI Assistant tidak tersedia (API key tidak dikonfigurasi di Railway Variables)"
-        elif not gemini_model:
-            message = """🤖 **AI Assistant**
-
-❌ AI tidak tersedia saat ini
-
-🔧 **Untuk mengaktifkan:**
-1. Install google-generativeai
-2. Set GEMINI_API_KEY di Railway
-3. Restart bot"""
-        else:
-            message = """🤖 **AI Assistant - Powered by Google Gemini**
-
-**Cara menggunakan:**
-• `/ask [pertanyaan]` - Tanya langsung ke AI
-• Atau ketik pertanyaan langsung (dengan tanda tanya)
-
-**Contoh pertanyaan:**
-• `/ask Apa itu saham?`
-• `/ask Bagaimana cara investasi yang aman?`
-• `/ask Perbedaan saham dan reksa dana?`
-• `/ask Analisis fundamental itu apa?`
-• `Kapan waktu yang tepat beli saham?`
-
-**AI ini bisa membantu:**
-✅ Edukasi dasar investasi
-✅ Penjelasan istilah keuangan
-✅ Tips strategi investasi
-✅ Analisis konsep saham
-✅ Diskusi risiko investasi
-
-🆓 **Gratis**: 1500 pertanyaan per hari
-⚠️ **Disclaimer**: AI memberikan informasi edukasi, bukan nasihat investasi pribadi"""
-        
-        keyboard = [[InlineKeyboardButton("🏠 Menu Utama", callback_data='back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(AI_HELP_TEXT, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
 
     async def show_help(self, query):
         """Show help"""
-        ai_status = "✅ Tersedia" if gemini_model else "❌ Tidak tersedia"
-        
-        message = f"""❓ **BANTUAN {BOT_NAME}**
-
-**Cara Menggunakan:**
-• `/start` - Mulai menggunakan bot
-• `/ask [pertanyaan]` - Tanya AI tentang saham/investasi
-• `/stock KODE` - Cari saham tertentu
-• Pilih menu dari tombol yang tersedia
-• Atau ketik kode saham langsung
-
-**Contoh penggunaan:**
-• `/ask Apa itu saham?`
-• `/stock BBCA` → Info Bank BCA  
-• `/stock GOTO` → Info GoTo
-• Ketik: `BBRI` → Info Bank BRI
-
-**Fitur:**
-✅ Data real-time saham Indonesia
-✅ Informasi IHSG
-✅ Saham-saham populer
-{ai_status} AI Assistant untuk konsultasi investasi
-✅ Interface yang mudah digunakan
-
-🔄 Bot akan coba mengambil data real-time
-📊 Jika Yahoo Finance maintenance, fitur pencarian tetap tersedia"""
-        
-        keyboard = [[InlineKeyboardButton("🏠 Menu Utama", callback_data='back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(HELP_TEXT, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
 
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages (stock search or AI chat)"""
         text = update.message.text.strip()
         
+        # Anything shaped like a ticker (optionally with .JK) is a stock search
+        match = TICKER_RE.match(text)
+        if match:
+            await self.search_stock(update, match.group(1).upper())
+            return
+        
         # Check if it's a question (contains question words)
-        question_words = ['apa', 'bagaimana', 'mengapa', 'kenapa', 'kapan', 'dimana', 'siapa', '?']
-        is_question = any(word in text.lower() for word in question_words) or text.endswith('?')
+        is_question = bool(QUESTION_RE.search(text))
         
         # If it looks like a question and longer than 10 characters, treat as AI chat
         if is_question and len(text) > 10:
-            await update.message.chat.send_action(action="typing")
-            ai_answer = await self.ai_chat(text)
-            await update.message.reply_text(ai_answer, parse_mode='Markdown')
+            await self.reply_ai(update, text)
             return
         
-        # Check if it looks like a stock code (short, alphabetic)
-        if len(text) <= 6 and text.upper().isalpha():
-            await self.search_stock(update, text.upper())
+        # For other text, suggest using /ask command
+        if gemini_model:
+            suggestion = f"<code>/ask {escape(text)}</code>"
         else:
-            # For other text, suggest using /ask command
-            suggestion = f"`/ask {text}`" if gemini_model else "`/stock KODE_SAHAM`"
-            
-            message = f"""💬 **Pesan Anda:** "{text}"
+            suggestion = "<code>/stock KODE_SAHAM</code>"
+        
+        message = f"""💬 <b>Pesan Anda:</b> "{escape(text)}"
 
 🤔 Sepertinya Anda ingin bertanya. Gunakan format:
 {suggestion}
 
 Atau ketik kode saham (contoh: BBCA, GOTO)"""
-            
-            await update.message.reply_text(message, parse_mode='Markdown')
+        
+        await update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 # ===================== MAIN FUNCTION =====================
 
@@ -521,7 +1064,7 @@ def main():
     print(f"AI_API_KEY: {'SET' if AI_API_KEY else 'NOT SET'}")
     print(f"BOT_NAME: {BOT_NAME}")
     print(f"GEMINI_AVAILABLE: {GEMINI_AVAILABLE}")
-    print(f"GEMINI_MODEL: {'Initialized' if gemini_model else 'Not available'}")
+    print(f"GEMINI_MODEL: {GEMINI_MODEL if gemini_model else 'Not available'}")
     
     if not TELEGRAM_BOT_TOKEN:
         print("\n❌ TELEGRAM_BOT_TOKEN tidak ditemukan!")
@@ -539,21 +1082,56 @@ def main():
     print(f"🚀 Starting {BOT_NAME}...")
     print(f"🤖 Token: {TELEGRAM_BOT_TOKEN[:10]}...")
     
+    # libuv-backed loop for the socket-heavy Telegram/Yahoo traffic
+    if UVLOOP_AVAILABLE:
+        uvloop.install()
+    
     # Create application
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
     bot = StockBot()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        # Smooth outbound sends under Telegram's flood limits, retrying on RetryAfter
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=29,
+            overall_time_period=1.017,
+            group_max_rate=19,
+            group_time_period=60,
+            max_retries=3,
+        ))
+        .post_shutdown(bot.close)
+        .build()
+    )
     
     # Register handlers
+    # Slow handlers (AI, market data) don't block the handler chain
     app.add_handler(CommandHandler("start", bot.start))
-    app.add_handler(CommandHandler("ask", bot.ask_command))
-    app.add_handler(CommandHandler("stock", bot.stock_command))
-    app.add_handler(CallbackQueryHandler(bot.button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text))
+    app.add_handler(CommandHandler("ask", bot.ask_command, block=False))
+    app.add_handler(CommandHandler("stock", bot.stock_command, block=False))
+    app.add_handler(CallbackQueryHandler(bot.button_handler, block=False))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text, block=False))
+    
+    # Refresh popular stocks in the background so user requests hit the cache,
+    # just before stock entries expire so they never go stale between runs
+    app.job_queue.run_repeating(bot.refresh_popular, interval=bot.cache_expiry - timedelta(seconds=30), first=0)
+    # IHSG's trading-hours TTL is much shorter, so it gets its own job
+    app.job_queue.run_repeating(bot.refresh_ihsg, interval=bot.index_expiry - timedelta(seconds=10), first=bot.index_expiry)
     
     # Run bot
     try:
-        print("🔄 Starting polling mode")
-        app.run_polling(drop_pending_updates=True)
+        if WEBHOOK_ENABLED and WEBHOOK_URL:
+            print(f"🌐 Starting webhook mode on port {PORT}")
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TELEGRAM_BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+                drop_pending_updates=True,
+            )
+        else:
+            print("🔄 Starting polling mode")
+            app.run_polling(drop_pending_updates=True)
             
     except KeyboardInterrupt:
         print("⏹️ Bot stopped")